@@ -1,16 +1,27 @@
 import aiohttp
 import asyncio
+import hashlib
+import json
+import logging
 import os
+import random
 import re
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext, suppress
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from typing import Dict, Set, List
+from typing import Awaitable, Callable, Dict, Set, List
+from urllib.parse import urlsplit
+from zoneinfo import ZoneInfo
 
-import pytz
+import orjson
 from aiogram import Bot, Dispatcher, F
-from aiogram.filters import CommandStart, Command
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.types import Message
-from dateutil import parser as dtparser
+from sortedcontainers import SortedSet
 
 
 # ====== Конфиг из env ======
@@ -21,6 +32,7 @@ FINNHUB_KEY = os.getenv("FINNHUB_KEY")
 TWELVEDATA_KEY = os.getenv("TWELVEDATA_KEY")
 RAPIDAPI_KEY = os.getenv("RAPIDAPI_KEY")
 LANG = os.getenv("NEWS_LANG", "ru")  # ru | pl | en
+STATE_DB = os.getenv("STATE_DB", "data/newsbot.db")  # SQLite с подписками чатов
 
 if not TELEGRAM_BOT_TOKEN:
     raise RuntimeError("Missing TELEGRAM_BOT_TOKEN")
@@ -29,19 +41,58 @@ if not SERPAPI_KEY:
 if not any([ALPHAVANTAGE_KEY, FINNHUB_KEY, TWELVEDATA_KEY, RAPIDAPI_KEY]):
     raise RuntimeError("Нужен хотя бы один ключ цен (ALPHAVANTAGE/FINNHUB/TWELVEDATA/RAPIDAPI)")
 
-TZ = pytz.timezone("Europe/Warsaw")
+TZ = ZoneInfo("Europe/Warsaw")
+
+log = logging.getLogger("newsbot")
 
 
 # ====== Состояние подписок (в памяти) ======
-@dataclass
+SEEN_IDS_CAP = 5000  # сколько последних ID новостей помним на чат
+
+
+class SeenIds:
+    """Множество ID просмотренных новостей с ограниченным размером (LRU):
+    при переполнении забываются самые давние, память на чат не растёт с аптаймом."""
+
+    __slots__ = ("cap", "_ids")
+
+    def __init__(self, cap: int = SEEN_IDS_CAP):
+        self.cap = cap
+        self._ids: "OrderedDict[int, None]" = OrderedDict()
+
+    def __contains__(self, nid: int) -> bool:
+        return nid in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __repr__(self) -> str:
+        return f"SeenIds({len(self._ids)}/{self.cap})"
+
+    def add(self, nid: int):
+        ids = self._ids
+        ids[nid] = None
+        ids.move_to_end(nid)
+        if len(ids) > self.cap:
+            ids.popitem(last=False)
+
+
+@dataclass(slots=True)  # без __dict__ на каждый чат: меньше памяти, быстрее доступ к полям
 class ChatState:
-    companies: Set[str] = field(default_factory=set)
-    tickers: Set[str] = field(default_factory=set)
-    news_seen_ids: Set[str] = field(default_factory=set)
+    # SortedSet: O(log n) на /watch_* и /unwatch_*, а цикл мониторинга и /list
+    # обходят подписки сразу в алфавитном порядке, без sorted() на каждом проходе
+    companies: SortedSet = field(default_factory=SortedSet)
+    tickers: SortedSet = field(default_factory=SortedSet)
+    news_seen_ids: SeenIds = field(default_factory=SeenIds)
     interval_min: int = 10
     price_threshold_pct: float = 2.0
     running: bool = False
-    task: asyncio.Task | None = None
+    # time.monotonic() последнего цикла; -inf — «ещё не было», а не 0.0:
+    # monotonic считает от загрузки системы, и 0.0 на свежей машине ещё не «давно»
+    last_run: float = float("-inf")
     debug: bool = False   # 👈 новое поле
 
 
@@ -49,7 +100,97 @@ STATES: Dict[int, ChatState] = {}  # chat_id -> ChatState
 dp = Dispatcher()
 
 
+# ====== Хранение состояния (SQLite) ======
+# Подписки и увиденные новости переживают перезапуск: иначе чаты теряют /watch_*,
+# а после старта приходит пачка уже отправленных новостей.
+SEEN_TTL_SEC = 24 * 3600  # старше суток новости всё равно отсекает фильтр свежести
+
+DB: sqlite3.Connection | None = None
+# Запись (с fsync на commit) — не в потоке event loop. Один поток: записи идут по порядку
+# и соединение не используется из двух потоков сразу.
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+
+def init_db(path: str = STATE_DB) -> sqlite3.Connection:
+    global DB
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    DB = sqlite3.connect(path, check_same_thread=False)  # пишет поток DB_EXECUTOR
+    DB.executescript("""
+        CREATE TABLE IF NOT EXISTS chats (
+            chat_id INTEGER PRIMARY KEY,
+            companies TEXT NOT NULL,
+            tickers TEXT NOT NULL,
+            interval_min INTEGER NOT NULL,
+            price_threshold_pct REAL NOT NULL,
+            running INTEGER NOT NULL,
+            debug INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS seen (
+            chat_id INTEGER NOT NULL,
+            nid INTEGER NOT NULL,
+            ts REAL NOT NULL,
+            PRIMARY KEY (chat_id, nid)
+        );
+    """)
+    return DB
+
+
+def load_states() -> Dict[int, ChatState]:
+    """Поднять все чаты из базы в STATES (вместе с недавно увиденными новостями)."""
+    DB.execute("DELETE FROM seen WHERE ts < ?", (time.time() - SEEN_TTL_SEC,))
+    DB.commit()
+    for chat_id, companies, tickers, interval_min, threshold, running, debug in DB.execute(
+            "SELECT chat_id, companies, tickers, interval_min, price_threshold_pct, running, debug FROM chats"):
+        STATES[chat_id] = ChatState(
+            companies=SortedSet(json.loads(companies)),
+            tickers=SortedSet(json.loads(tickers)),
+            interval_min=interval_min,
+            price_threshold_pct=threshold,
+            running=bool(running),
+            debug=bool(debug),
+        )
+    for chat_id, nid in DB.execute("SELECT chat_id, nid FROM seen ORDER BY ts"):
+        if chat_id in STATES:
+            STATES[chat_id].news_seen_ids.add(nid)
+    return STATES
+
+
+def _write_state(row: tuple):
+    DB.execute("INSERT OR REPLACE INTO chats VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+    DB.commit()
+
+
+def _write_seen(rows: List[tuple[int, int]]):
+    now = time.time()
+    DB.executemany("INSERT OR REPLACE INTO seen VALUES (?, ?, ?)", [(c, nid, now) for c, nid in rows])
+    DB.execute("DELETE FROM seen WHERE ts < ?", (now - SEEN_TTL_SEC,))
+    DB.commit()
+
+
+async def save_state(chat_id: int, state: ChatState):
+    """Записать настройки и подписки чата; вызывается после каждого изменения."""
+    if DB is None:
+        return
+    # снимок берём здесь, пока хендлеры не успели снова поменять состояние
+    row = (chat_id, json.dumps(list(state.companies)), json.dumps(list(state.tickers)),
+           state.interval_min, state.price_threshold_pct, int(state.running), int(state.debug))
+    await asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, _write_state, row)
+
+
+async def save_seen(rows: List[tuple[int, int]]):
+    """Дописать отправленные за цикл новости (chat_id, nid) одним commit и выбросить старше SEEN_TTL_SEC."""
+    if DB is None or not rows:
+        return
+    await asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, _write_seen, rows)
+
+
 # ====== Утилиты ======
+_REL_RE = re.compile(r"(\d+)\s+(minute|hour|day)")
+_UNIT_SECS = {"minute": 60, "hour": 3600, "day": 86400}
+_CMD_RE = re.compile(r"^/")  # сообщение-команда (для fallback-хендлера)
+
+
 def now_tz() -> datetime:
     return datetime.now(TZ)
 
@@ -59,59 +200,245 @@ def parse_relative_date(text: str) -> datetime | None:
     text = (text or "").lower()
     if not text:
         return None
-    if "just now" in text:
+    if text.startswith("just now"):
         return now_tz()
-    m = re.search(r"(\d+)\s+(minute|hour|day)", text)
-    if m:
-        n = int(m.group(1))
-        unit = m.group(2)
-        base = now_tz()
-        if unit == "minute": return base - timedelta(minutes=n)
-        if unit == "hour":   return base - timedelta(hours=n)
-        if unit == "day":    return base - timedelta(days=n)
-    # иногда приходит ISO
+    if text.endswith(" ago"):
+        m = _REL_RE.search(text)
+        if m:
+            return now_tz() - timedelta(seconds=int(m.group(1)) * _UNIT_SECS[m.group(2)])
+    # иногда приходит ISO (fromisoformat с 3.11 понимает почти весь ISO 8601)
     try:
-        return dtparser.isoparse(text).astimezone(TZ)
-    except Exception:
+        iso = text[:-1] + "+00:00" if text.endswith("z") else text
+        return datetime.fromisoformat(iso).astimezone(TZ)
+    except ValueError:
         return None
 
 
-def short(src: str, maxlen=64):
-    s = (src or "").strip()
-    return s if len(s) <= maxlen else s[:maxlen - 1] + "…"
+def news_id(title: str, link: str | None, date_raw: str | None) -> int:
+    """64-битный ID новости по заголовку/ссылке/дате: в наборе просмотренных лежат
+    короткие int вместо строк по 200+ символов. Коллизии на таких объёмах не грозят."""
+    key = f"{title}|{link}|{date_raw}".encode()
+    # signed — чтобы значение помещалось в INTEGER SQLite
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big", signed=True)
+
+
+_ELLIPSIS = "…"
+
+
+def short(src: str, maxlen=64, _ell=_ELLIPSIS):
+    # _ell — default-аргумент, чтобы в горячем цикле это было чтение локальной переменной
+    s = src.strip() if src else ""
+    return s if len(s) <= maxlen else s[:maxlen - 1] + _ell
+
+
+# ====== Общие HTTP-сессия и бот ======
+# Одна сессия на весь процесс: TCP/TLS-соединения и DNS переиспользуются между чатами и циклами
+SESSION: aiohttp.ClientSession | None = None
+BOT: Bot | None = None
+
+
+async def get_session() -> aiohttp.ClientSession:
+    global SESSION
+    if SESSION is None or SESSION.closed:
+        SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=256, limit_per_host=64,
+                use_dns_cache=True, ttl_dns_cache=300,  # DNS провайдеров резолвим раз в 5 минут
+                keepalive_timeout=60,  # соединение живёт между соседними запросами цикла
+            ),
+            timeout=aiohttp.ClientTimeout(total=20),
+        )
+    return SESSION
+
+
+# ====== Ограничение частоты запросов (token bucket на хост) ======
+class RateLimited(aiohttp.ClientError):
+    """Лимит провайдера исчерпан, а ждать новый токен слишком долго."""
+
+
+class TokenBucket:
+    """rate запросов за per секунд. Токен резервируется сразу (баланс может уйти в минус),
+    поэтому параллельные вызовы встают в очередь без Lock и каждый знает свою паузу."""
+
+    def __init__(self, rate: int, per: float, max_wait: float | None = None):
+        self.capacity = rate
+        self.fill_rate = rate / per
+        self.max_wait = max_wait  # None — ждать сколько нужно
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    async def acquire(self):
+        self._refill()
+        wait = max(0.0, (1 - self.tokens) / self.fill_rate)
+        if self.max_wait is not None and wait > self.max_wait:
+            raise RateLimited(f"rate limit: next slot in {wait:.1f}s")
+        self.tokens -= 1
+        if wait:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                # хедж отменил нас до запроса — токен не потрачен, возвращаем
+                self._refill()
+                self.tokens = min(self.capacity, self.tokens + 1)
+                raise
+
+    def update_from_headers(self, headers):
+        """Если провайдер сообщает остаток лимита — не даём себе больше, чем он разрешает."""
+        remaining = headers.get("X-RateLimit-Remaining")
+        if remaining and remaining.isdigit():
+            self._refill()
+            self.tokens = min(self.tokens, float(remaining))
+
+
+# Лимиты бесплатных тарифов. Для котировок долго не ждём — есть запасные провайдеры,
+# у новостей запасного нет, поэтому SerpAPI ждёт свою очередь.
+BUCKETS: Dict[str, TokenBucket] = {
+    "serpapi.com": TokenBucket(1, 1),
+    "www.alphavantage.co": TokenBucket(5, 60, max_wait=4),
+    "finnhub.io": TokenBucket(60, 60, max_wait=4),
+    "api.twelvedata.com": TokenBucket(8, 60, max_wait=4),
+    "yahoo-finance127.p.rapidapi.com": TokenBucket(5, 1, max_wait=4),
+}
+
+
+# Сколько запросов к одному хосту держим в полёте одновременно
+HOST_SEMAPHORES: Dict[str, asyncio.Semaphore] = {
+    "serpapi.com": asyncio.Semaphore(5),
+    "www.alphavantage.co": asyncio.Semaphore(2),
+    "finnhub.io": asyncio.Semaphore(5),
+    "api.twelvedata.com": asyncio.Semaphore(2),
+    "yahoo-finance127.p.rapidapi.com": asyncio.Semaphore(3),
+}
+
+
+# ====== Условные запросы (ETag / Last-Modified) ======
+# Если провайдер отдаёт валидаторы, в следующий раз спрашиваем If-None-Match/If-Modified-Since:
+# на 304 тело не передаётся и не разбирается — берём прошлый разобранный ответ.
+HTTP_CACHE_MAX = 1024
+HTTP_CACHE: "OrderedDict[tuple, tuple[dict, object]]" = OrderedDict()  # ключ запроса -> (заголовки, данные)
+
+
+def _http_cache_key(url: str, params: dict | None) -> tuple:
+    return url, tuple(sorted(params.items())) if params else ()
+
+
+def _http_cache_store(key: tuple, headers, data):
+    validators = {}
+    if headers.get("ETag"):
+        validators["If-None-Match"] = headers["ETag"]
+    if headers.get("Last-Modified"):
+        validators["If-Modified-Since"] = headers["Last-Modified"]
+    if not validators:
+        return
+    HTTP_CACHE[key] = (validators, data)
+    HTTP_CACHE.move_to_end(key)
+    if len(HTTP_CACHE) > HTTP_CACHE_MAX:
+        HTTP_CACHE.popitem(last=False)
+
+
+# ====== HTTP-запросы с повторами ======
+RETRY_ATTEMPTS = 3
+RETRY_STATUSES = (429, 503)
+RETRY_BASE_DELAY = 0.5  # сек, удваивается с каждой попыткой
+RETRY_MAX_DELAY = 4.0   # дольше ждать нет смысла — лучше уйти на следующий провайдер
+
+
+def _retry_delay(attempt: int, retry_after: str | None = None) -> float | None:
+    """Пауза перед следующей попыткой; None — если провайдер просит ждать слишком долго."""
+    if retry_after and retry_after.isdigit():
+        delay = float(retry_after)
+        return delay if delay <= RETRY_MAX_DELAY else None
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) + random.uniform(0, RETRY_BASE_DELAY)
+
+
+async def _get_json(session: aiohttp.ClientSession, url: str, **kw):
+    """GET и разбор JSON с учётом лимита (BUCKETS) и параллельности (HOST_SEMAPHORES) хоста,
+    условным запросом, если есть валидаторы прошлого ответа (HTTP_CACHE).
+    На 429/503 ждём Retry-After (или экспоненциальную паузу с джиттером), на сетевые ошибки
+    и таймауты — экспоненциальную паузу. Не больше RETRY_ATTEMPTS попыток,
+    после чего исключение уходит вызывающему."""
+    host = urlsplit(url).hostname
+    bucket = BUCKETS.get(host)
+    sem = HOST_SEMAPHORES.get(host) or nullcontext()
+    ckey = _http_cache_key(url, kw.get("params"))
+    cached = HTTP_CACHE.get(ckey)
+    if cached:
+        kw["headers"] = {**(kw.get("headers") or {}), **cached[0]}
+    for attempt in range(RETRY_ATTEMPTS):
+        last = attempt == RETRY_ATTEMPTS - 1
+        if bucket:
+            await bucket.acquire()
+        try:
+            async with sem, session.get(url, **kw) as r:
+                if bucket:
+                    bucket.update_from_headers(r.headers)
+                if r.status == 304 and cached:
+                    return cached[1]
+                delay = None
+                if r.status in RETRY_STATUSES and not last:
+                    delay = _retry_delay(attempt, r.headers.get("Retry-After"))
+                if delay is None:
+                    r.raise_for_status()
+                    # orjson разбирает сырые байты: без промежуточного str и проверки Content-Type
+                    data = orjson.loads(await r.read())
+                    _http_cache_store(ckey, r.headers, data)
+                    return data
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if last:
+                raise
+            delay = _retry_delay(attempt)
+        await asyncio.sleep(delay)
 
 
 # ====== Провайдеры ======
+# URL и неизменная часть параметров собираются один раз при импорте,
+# в запросе к ним добавляется только символ/запрос
+_SERPAPI_URL = "https://serpapi.com/search.json"
+_SERPAPI_PARAMS = {
+    "engine": "google_news",
+    "hl": LANG,
+    "api_key": SERPAPI_KEY,
+    "tbs": "qdr:h"  # за последний час; можно qdr:d — за сутки
+}
+_ALPHA_URL = "https://www.alphavantage.co/query"
+_ALPHA_PARAMS = {"function": "GLOBAL_QUOTE", "apikey": ALPHAVANTAGE_KEY}
+_FINNHUB_URL = "https://finnhub.io/api/v1/quote"
+_FINNHUB_PARAMS = {"token": FINNHUB_KEY}
+_TWELVEDATA_PRICE_URL = "https://api.twelvedata.com/price"
+_TWELVEDATA_QUOTE_URL = "https://api.twelvedata.com/quote"
+_TWELVEDATA_PARAMS = {"apikey": TWELVEDATA_KEY}
+_RAPIDAPI_YAHOO_URL = "https://yahoo-finance127.p.rapidapi.com/price"
+_RAPIDAPI_HEADERS = {
+    "x-rapidapi-key": RAPIDAPI_KEY or "",
+    "x-rapidapi-host": "yahoo-finance127.p.rapidapi.com",
+}
+
+
 async def fetch_serpapi_news(session: aiohttp.ClientSession, query: str, num: int = 6):
-    url = "https://serpapi.com/search.json"
-    params = {
-        "engine": "google_news",
-        "q": query,
-        "hl": LANG,
-        "num": num,
-        "api_key": SERPAPI_KEY,
-        "tbs": "qdr:h"  # за последний час; можно qdr:d — за сутки
-    }
-    async with session.get(url, params=params, timeout=20) as r:
-        r.raise_for_status()
-        data = await r.json()
-    results = []
-    for v in (data.get("news_results") or [])[:num]:
-        title = (v.get("title") or "").strip()
-        link = v.get("link")
-        source = (v.get("source") or {}).get("name", "")
-        date_raw = v.get("date")
-        dt = parse_relative_date(date_raw)
-        # ID новости — по ссылке/тайтлу/дате, чтобы отсечь дубли
-        nid = f"{title}|{link}|{date_raw}"
-        results.append({
-            "id": nid,
+    params = {**_SERPAPI_PARAMS, "q": query, "num": num}
+    data = await _get_json(session, _SERPAPI_URL, params=params)
+    prd = parse_relative_date
+    # ID новости — по ссылке/тайтлу/дате, чтобы отсечь дубли;
+    # внутренние for по одноэлементным спискам просто связывают title/link/date_raw и dt.
+    # epoch — для быстрого фильтра свежести, dt — для показа
+    return [
+        {
+            "id": news_id(title, link, date_raw),
             "title": title,
             "url": link,
-            "source": source,
-            "dt": dt
-        })
-    return results
+            "source": (v.get("source") or {}).get("name", ""),
+            "dt": dt,
+            "epoch": int(dt.timestamp()) if dt else None,
+        }
+        for v in (data.get("news_results") or [])[:num]
+        for title, link, date_raw in [((v.get("title") or "").strip(), v.get("link"), v.get("date"))]
+        for dt in [prd(date_raw)]
+    ]
 
 
 # ====== Источники котировок (цен) с одинаковым интерфейсом ======
@@ -120,15 +447,10 @@ async def fetch_alpha_global_quote(session: aiohttp.ClientSession, symbol: str):
     """Alpha Vantage GLOBAL_QUOTE: (price, change_pct) | (None, None)"""
     if not ALPHAVANTAGE_KEY:
         return None, None
-    url = "https://www.alphavantage.co/query"
-    params = {"function": "GLOBAL_QUOTE", "symbol": symbol, "apikey": ALPHAVANTAGE_KEY}
+    params = {**_ALPHA_PARAMS, "symbol": symbol}
     try:
-        async with session.get(url, params=params, timeout=20) as r:
-            # 429 бывает редко; чаще 200 + "Note"
-            if r.status in (403, 429):
-                return None, None
-            r.raise_for_status()
-            data = await r.json()
+        # 429 бывает редко; чаще 200 + "Note". 403/429 после повторов -> исключение -> (None, None)
+        data = await _get_json(session, _ALPHA_URL, params=params)
         # частые "тихие" ответы при лимитах:
         # {"Note": "..."} или {"Information": "..."} или {"Error Message": "..."}
         if any(k in data for k in ("Note", "Information", "Error Message")):
@@ -147,14 +469,9 @@ async def fetch_finnhub_quote(session: aiohttp.ClientSession, symbol: str):
     """Finnhub /quote: c=current, dp=percent change"""
     if not FINNHUB_KEY:
         return None, None
-    url = "https://finnhub.io/api/v1/quote"
-    params = {"symbol": symbol, "token": FINNHUB_KEY}
+    params = {**_FINNHUB_PARAMS, "symbol": symbol}
     try:
-        async with session.get(url, params=params, timeout=20) as r:
-            if r.status == 429:
-                return None, None
-            r.raise_for_status()
-            data = await r.json()
+        data = await _get_json(session, _FINNHUB_URL, params=params)
         price = data.get("c")
         chg_pct = data.get("dp")
         if price is None or chg_pct is None:
@@ -168,27 +485,16 @@ async def fetch_twelvedata_price(session: aiohttp.ClientSession, symbol: str):
     """Twelve Data /price + /quote (для процента). Возвращаем (price, change_pct)."""
     if not TWELVEDATA_KEY:
         return None, None
+    params = {**_TWELVEDATA_PARAMS, "symbol": symbol}
     try:
         # цена
-        url_p = "https://api.twelvedata.com/price"
-        params_p = {"symbol": symbol, "apikey": TWELVEDATA_KEY}
-        async with session.get(url_p, params=params_p, timeout=20) as r1:
-            if r1.status == 429:
-                return None, None
-            r1.raise_for_status()
-            data_p = await r1.json()
+        data_p = await _get_json(session, _TWELVEDATA_PRICE_URL, params=params)
         price = data_p.get("price")
         if price is None:
             return None, None
         price = float(price)
         # процент изменения
-        url_q = "https://api.twelvedata.com/quote"
-        params_q = {"symbol": symbol, "apikey": TWELVEDATA_KEY}
-        async with session.get(url_q, params=params_q, timeout=20) as r2:
-            if r2.status == 429:
-                return None, None
-            r2.raise_for_status()
-            data_q = await r2.json()
+        data_q = await _get_json(session, _TWELVEDATA_QUOTE_URL, params=params)
         chg_pct = data_q.get("percent_change")
         if chg_pct is None:
             return price, None
@@ -197,44 +503,12 @@ async def fetch_twelvedata_price(session: aiohttp.ClientSession, symbol: str):
         return None, None
 
 
-async def fetch_yahoo_via_rapidapi(session: aiohttp.ClientSession, symbol: str):
-    """Yahoo Finance через RapidAPI. Отдаём pre/post/regular если доступны."""
-    if not RAPIDAPI_KEY:
-        return None, None, "Yahoo"
-
-    url = "https://yahoo-finance127.p.rapidapi.com/price"
-    headers = {
-        "x-rapidapi-key": RAPIDAPI_KEY,
-        "x-rapidapi-host": "yahoo-finance127.p.rapidapi.com",
-    }
-    params = {"symbol": symbol}
-    try:
-        async with session.get(url, headers=headers, params=params, timeout=20) as r:
-            if r.status == 429:
-                return None, None, "Yahoo"
-            r.raise_for_status()
-            data = await r.json()
-
-        quote = data.get("price") or data
-
-        def val(field):
-            v = quote.get(field)
-            return v.get("raw") if isinstance(v, dict) else v
-
-        pre_p,  pre_dp  = val("preMarketPrice"),           val("preMarketChangePercent")
-        post_p, post_dp = val("postMarketPrice"),          val("postMarketChangePercent")
-        reg_p,  reg_dp  = val("regularMarketPrice"),       val("regularMarketChangePercent")
-
-        if pre_p is not None and pre_dp is not None:
-            return float(pre_p),  float(pre_dp),  "Yahoo Pre-Market"
-        if post_p is not None and post_dp is not None:
-            return float(post_p), float(post_dp), "Yahoo Post-Market"
-        if reg_p is not None and reg_dp is not None:
-            return float(reg_p),  float(reg_dp),  "Yahoo Regular"
+_YAHOO_FIELDS = (
+    "preMarketPrice", "preMarketChangePercent",
+    "postMarketPrice", "postMarketChangePercent",
+    "regularMarketPrice", "regularMarketChangePercent",
+)
 
-        return None, None, "Yahoo"
-    except Exception:
-        return None, None, "Yahoo"
 
 async def fetch_yahoo_sessions(session: aiohttp.ClientSession, symbol: str):
     """
@@ -244,28 +518,17 @@ async def fetch_yahoo_sessions(session: aiohttp.ClientSession, symbol: str):
     if not RAPIDAPI_KEY:
         return {}
 
-    url = "https://yahoo-finance127.p.rapidapi.com/price"
-    headers = {
-        "x-rapidapi-key": RAPIDAPI_KEY,
-        "x-rapidapi-host": "yahoo-finance127.p.rapidapi.com",
-    }
-    params = {"symbol": symbol}
     try:
-        async with session.get(url, headers=headers, params=params, timeout=20) as r:
-            if r.status == 429:
-                return {}
-            r.raise_for_status()
-            data = await r.json()
+        data = await _get_json(session, _RAPIDAPI_YAHOO_URL, headers=_RAPIDAPI_HEADERS,
+                               params={"symbol": symbol})
 
         quote = data.get("price") or data
 
-        def val(field):
-            v = quote.get(field)
-            return (v.get("raw") if isinstance(v, dict) else v)
-
-        pre_p,  pre_dp  = val("preMarketPrice"),           val("preMarketChangePercent")
-        post_p, post_dp = val("postMarketPrice"),          val("postMarketChangePercent")
-        reg_p,  reg_dp  = val("regularMarketPrice"),       val("regularMarketChangePercent")
+        # один проход по полям; RapidAPI отдаёт либо {"raw": ...}, либо голое число
+        raw = [quote.get(f) for f in _YAHOO_FIELDS]
+        pre_p, pre_dp, post_p, post_dp, reg_p, reg_dp = [
+            v.get("raw") if isinstance(v, dict) else v for v in raw
+        ]
 
         out = {}
         if pre_p  is not None and pre_dp  is not None: out["pre"]     = (float(pre_p),  float(pre_dp))
@@ -276,116 +539,351 @@ async def fetch_yahoo_sessions(session: aiohttp.ClientSession, symbol: str):
         return {}
 
 
-async def get_stock_price(session: aiohttp.ClientSession, symbol: str):
+_YAHOO_PRIORITY = (("pre", "Yahoo Pre-Market"), ("post", "Yahoo Post-Market"), ("regular", "Yahoo Regular"))
+
+
+def pick_best_session(sessions: dict):
+    """Лучшая из сессий Yahoo (pre -> post -> regular): (price, change_pct, label)."""
+    for key, label in _YAHOO_PRIORITY:
+        if key in sessions:
+            p, c = sessions[key]
+            return p, c, label
+    return None, None, "Yahoo"
+
+
+async def fetch_yahoo_quote(session: aiohttp.ClientSession, symbol: str):
+    """Yahoo как провайдер цены с тем же интерфейсом, что и остальные: (price, pct, label)."""
+    return pick_best_session(await fetch_yahoo_sessions(session, symbol))
+
+
+HEDGE_DELAY = 1.0  # сек: фора провайдеру с бо́льшим приоритетом, прежде чем спросить следующего
+
+
+def _labeled(fetch, name: str):
+    """Привести (price, pct) к (price, pct, provider), как у Yahoo."""
+    async def run(session: aiohttp.ClientSession, symbol: str):
+        p, c = await fetch(session, symbol)
+        return p, c, name
+    return run
+
+
+async def get_stock_price(session: aiohttp.ClientSession, symbol: str, yahoo_sessions: dict | None = None):
     """
     Предпочитаем pre/post с Yahoo (если ключ есть),
     затем Alpha Vantage -> Finnhub -> TwelveData.
     Возвращаем (price, change_pct, provider).
+
+    yahoo_sessions — уже полученный ответ fetch_yahoo_sessions: тогда Yahoo второй раз не запрашиваем.
+
+    Провайдеры стартуют лесенкой (hedged requests): следующий запускается, если предыдущий
+    не ответил за HEDGE_DELAY или ответил пустым. Побеждает первый непустой ответ,
+    остальные запросы отменяются — медленный провайдер больше не держит весь цикл.
     """
-    # 0) Yahoo (даёт pre/post/regular)
-    if RAPIDAPI_KEY:
-        p, c, label = await fetch_yahoo_via_rapidapi(session, symbol)
-        if p is not None and c is not None:
+    providers = []
+    if yahoo_sessions is not None:
+        p, c, label = pick_best_session(yahoo_sessions)
+        if p is not None:
             return p, c, label
+    elif RAPIDAPI_KEY:
+        providers.append(fetch_yahoo_quote)  # даёт pre/post/regular
+    providers += [
+        _labeled(fetch_alpha_global_quote, "AlphaVantage"),
+        _labeled(fetch_finnhub_quote, "Finnhub"),
+        _labeled(fetch_twelvedata_price, "TwelveData"),
+    ]
+
+    order: Dict[asyncio.Task, int] = {}  # задача -> приоритет провайдера
+    pending: Set[asyncio.Task] = set()
+    try:
+        for i, fetch in enumerate(providers):
+            task = asyncio.create_task(fetch(session, symbol))
+            order[task] = i
+            pending.add(task)
+            last = i == len(providers) - 1
+            # ждём фору (или до конца, если запускать больше некого)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=None if last else HEDGE_DELAY, return_when=asyncio.FIRST_COMPLETED)
+                for d in sorted(done, key=order.get):
+                    p, c, label = d.result()
+                    if p is not None and c is not None:
+                        return p, c, label
+                if not last:
+                    break  # фора вышла или ответ пустой — подключаем следующего
+    finally:
+        for task in pending:
+            task.cancel()
+
+    return None, None, "none"
 
-    # 1) Alpha Vantage
-    p, c = await fetch_alpha_global_quote(session, symbol)
-    if p is not None and c is not None:
-        return p, c, "AlphaVantage"
 
-    # 2) Finnhub
-    p, c = await fetch_finnhub_quote(session, symbol)
-    if p is not None and c is not None:
-        return p, c, "Finnhub"
+# ====== Общий кэш запросов (на все чаты) ======
+# Несколько чатов часто следят за одними и теми же компаниями/тикерами —
+# в пределах TTL ходим к провайдеру один раз, остальные берут из кэша.
+# Проверка и запись делаются без await между ними, поэтому отдельный Lock не нужен.
+CACHE_MAX_ITEMS = 1024
+COMMAND_CACHE_TTL = 15  # сек: для /price и /premarket — свежесть важнее, но повторы подряд не нужны
 
-    # 3) Twelve Data
-    p, c = await fetch_twelvedata_price(session, symbol)
-    if p is not None and c is not None:
-        return p, c, "TwelveData"
+_quote_cache: Dict[str, tuple[float, tuple]] = {}
+_news_cache: Dict[str, tuple[float, list]] = {}
+_yahoo_cache: Dict[str, tuple[float, dict]] = {}
+_inflight: Dict[str, asyncio.Future] = {}  # ключ -> исход запроса, который уже в полёте
 
-    return None, None, "none"
 
-# ====== Фоновая задача ======
-async def monitor_chat(bot: Bot, chat_id: int):
-    state = STATES[chat_id]
-    async with aiohttp.ClientSession() as session:
-        while state.running:
-            start_cycle = now_tz()
-            msgs: List[str] = []
-
-            # --- Новости по компаниям ---
-            for company in sorted(state.companies):
-                try:
-                    news = await fetch_serpapi_news(session, company, num=6)
-                    fresh = []
-                    for n in news:
-                        # фильтруем новые (не виденные) и достаточно свежие (за интервал)
-                        if n["id"] in state.news_seen_ids:
-                            continue
-                        if n["dt"] and (start_cycle - n["dt"]).total_seconds() > state.interval_min * 60 + 120:
-                            continue
-                        fresh.append(n)
-                        state.news_seen_ids.add(n["id"])
-                    for n in fresh:
-                        when = n["dt"].strftime("%Y-%m-%d %H:%M") if n["dt"] else ""
-                        src = f" — {short(n['source'])}" if n["source"] else ""
-                        ds = f" ({when})" if when else ""
-                        msgs.append(f"📰 {company}{src}{ds}\n{n['title']}\n{n['url']}")
-                except Exception:
-                    # не падаем из-за одного провайдера
-                    pass
-
-            # --- Цены по тикерам ---
-
-            for t in sorted(state.tickers):
-                try:
-                    if RAPIDAPI_KEY:
-                        sessions = await fetch_yahoo_sessions(session, t)
-                        if "pre" in sessions:
-                            p, c = sessions["pre"]
-                            msgs.append(f"🕒 Pre-Market {t}: {p:.2f} USD ({c:+.2f}%) • Yahoo")
-
-                    price, chg, provider = await get_stock_price(session, t)
-                    if price is None or chg is None:
-                        continue
-                    if abs(chg) >= state.price_threshold_pct or state.debug:
-                        arrow = "📈" if chg > 0 else "📉" if chg < 0 else "➡️"
-                        dbg = " (debug)" if state.debug and abs(chg) < state.price_threshold_pct else ""
-                        msgs.append(
-                            f"{arrow} {t}: {price:.2f} USD ({chg:+.2f}%) • {provider}{dbg}\n"
-                            f"https://finance.yahoo.com/quote/{t}"
-                        )
-                except Exception:
-                    pass
-
-            if msgs:
-                text = "\n\n".join(msgs)
-                # бьем на куски < 4000 символов
-                for chunk in split_message(text):
-                    await bot.send_message(chat_id, chunk, disable_web_page_preview=False)
-
-            # Ждём до следующего цикла опроса
-            await asyncio.sleep(state.interval_min * 60)
-
-
-def split_message(text: str, limit: int = 4000):
-    if len(text) <= limit:
-        return [text]
-    parts, buf, size = [], [], 0
-    for block in text.split("\n\n"):
-        if size + len(block) + 2 > limit:
-            parts.append("\n\n".join(buf))
-            buf, size = [block], len(block)
-        else:
-            buf.append(block);
-            size += len(block) + 2
+async def _cached(cache: dict, key: str, ttl: float, fetch: Callable[[], Awaitable]):
+    """Вернуть значение из кэша, если оно моложе ttl; иначе сходить за ним один раз.
+
+    Параллельные вызовы с тем же ключом ждут уже идущий запрос, а не шлют свой,
+    и получают его исход — в том числе ошибку, чтобы не повторять упавший запрос по очереди.
+    """
+    while True:
+        hit = cache.get(key)
+        if hit and time.monotonic() - hit[0] < ttl:
+            return hit[1]
+        fut = _inflight.get(key)
+        if fut is None:
+            break
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            if not fut.cancelled():
+                raise  # отменили нас самих
+            # отменили того, кто запрашивал (проигравший хедж) — идём сами
+
+    fut = _inflight[key] = asyncio.get_running_loop().create_future()
+    try:
+        val = await fetch()
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # ждущих может не быть — не даём asyncio ругаться на непрочитанную ошибку
+        raise
+    finally:
+        del _inflight[key]
+    now = time.monotonic()
+    cache[key] = (now, val)
+    if len(cache) > CACHE_MAX_ITEMS:
+        for k in [k for k, (ts, _) in cache.items() if now - ts >= ttl]:
+            del cache[k]
+    fut.set_result(val)
+    return val
+
+
+async def cached_get_stock_price(session: aiohttp.ClientSession, symbol: str, ttl: float,
+                                 yahoo_sessions: dict | None = None):
+    return await _cached(_quote_cache, f"quote:{symbol}", ttl,
+                         lambda: get_stock_price(session, symbol, yahoo_sessions))
+
+
+async def cached_fetch_yahoo_sessions(session: aiohttp.ClientSession, symbol: str, ttl: float):
+    # пустой ответ (429, нет ключа) тоже кэшируем — не долбим RapidAPI повторно
+    return await _cached(_yahoo_cache, f"yahoo:{symbol}", ttl,
+                         lambda: fetch_yahoo_sessions(session, symbol))
+
+
+async def cached_fetch_serpapi_news(session: aiohttp.ClientSession, query: str, num: int, ttl: float):
+    return await _cached(_news_cache, f"news:{query}|{num}", ttl,
+                         lambda: fetch_serpapi_news(session, query, num=num))
+
+
+# ====== Отправка в Telegram с учётом лимитов ======
+# Telegram режет бота после ~30 сообщений/с суммарно и ~1 сообщения/с в один чат;
+# 429 от него тормозит всех пользователей сразу, поэтому темп держим сами.
+TG_BUCKET = TokenBucket(28, 1)
+TG_CHAT_INTERVAL = 1.0  # сек между сообщениями в один чат
+
+_chat_send_locks: Dict[int, asyncio.Lock] = {}
+_chat_last_send: Dict[int, float] = {}
+
+
+async def send_text(bot: Bot, chat_id: int, text: str):
+    """Отправить сообщение в общем темпе бота и не чаще TG_CHAT_INTERVAL в чат.
+    На TelegramRetryAfter ждём, сколько попросили, и повторяем то же сообщение —
+    так порядок сообщений в чате не меняется."""
+    async with _chat_send_locks.setdefault(chat_id, asyncio.Lock()):
+        wait = _chat_last_send.get(chat_id, 0.0) + TG_CHAT_INTERVAL - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        for attempt in range(RETRY_ATTEMPTS):
+            await TG_BUCKET.acquire()
+            try:
+                await bot.send_message(chat_id, text, disable_web_page_preview=False)
+                break
+            except TelegramRetryAfter as e:
+                if attempt == RETRY_ATTEMPTS - 1:
+                    raise
+                await asyncio.sleep(e.retry_after)
+        _chat_last_send[chat_id] = time.monotonic()
+
+
+# ====== Фоновая задача: один планировщик на все чаты ======
+# Вместо задачи на каждый чат — общий цикл: собирает чаты, которым пора, объединяет их
+# компании/тикеры в один план запросов (каждый символ — один раз) и раздаёт результаты
+# по чатам с их порогами и просмотренными новостями.
+FETCH_CONCURRENCY = 8     # одновременных запросов к провайдерам за цикл
+SCHEDULER_MAX_SLEEP = 60  # сек: планировщик просыпается не реже, даже если ждать некого
+# Чаты, которым пора одновременно, и так делят один план запросов. Между циклами кэш
+# держим коротким: фильтр свежести в build_messages считает от начала цикла, и данные
+# возрастом в интервал потеряли бы новости, вышедшие сразу после прошлого запроса.
+PLAN_CACHE_TTL = 30  # сек: заметно меньше запаса +120 с в фильтре свежести
+
+SCHEDULER_WAKEUP = asyncio.Event()  # /start_feed будит планировщик, чтобы первый цикл шёл сразу
+
+
+async def fetch_plan(session: aiohttp.ClientSession, companies: List[str], tickers: List[str], ttl: float):
+    """Сходить за новостями и котировками параллельно.
+    Возвращает {company: news | Exception} и {ticker: (sessions, (price, pct, provider)) | Exception}."""
+    sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+    async def one_company(company: str):
+        async with sem:
+            return await cached_fetch_serpapi_news(session, company, 6, ttl)
+
+    async def one_ticker(t: str):
+        async with sem:
+            # один запрос к Yahoo на тикер: из него и строка Pre-Market, и цена
+            sessions = await cached_fetch_yahoo_sessions(session, t, ttl) if RAPIDAPI_KEY else {}
+            return sessions, await cached_get_stock_price(session, t, ttl, sessions)
+
+    news_results, ticker_results = await asyncio.gather(
+        asyncio.gather(*[one_company(c) for c in companies], return_exceptions=True),
+        asyncio.gather(*[one_ticker(t) for t in tickers], return_exceptions=True),
+    )
+    return dict(zip(companies, news_results)), dict(zip(tickers, ticker_results))
+
+
+def build_messages(chat_id: int, state: ChatState, start_cycle: datetime,
+                   news_by_company: dict, quotes_by_ticker: dict, seen_rows: List[tuple[int, int]]) -> List[str]:
+    """Сообщения для одного чата из общих результатов цикла; отмечает новости как просмотренные.
+    Новые (chat_id, nid) дописывает в seen_rows — в базу их пишет run_cycle разом за весь цикл."""
+    msgs: List[str] = []
+
+    # --- Новости по компаниям ---
+    start_epoch = int(start_cycle.timestamp())
+    max_age = state.interval_min * 60 + 120
+    for company in state.companies:
+        news = news_by_company.get(company)
+        if news is None or isinstance(news, BaseException):
+            # не падаем из-за одного провайдера
+            continue
+        fresh = []
+        for n in news:
+            # фильтруем новые (не виденные) и достаточно свежие (за интервал)
+            if n["id"] in state.news_seen_ids:
+                continue
+            if n["epoch"] and start_epoch - n["epoch"] > max_age:
+                continue
+            fresh.append(n)
+            state.news_seen_ids.add(n["id"])
+            seen_rows.append((chat_id, n["id"]))
+        for n in fresh:
+            when = n["dt"].strftime("%Y-%m-%d %H:%M") if n["dt"] else ""
+            src = f" — {short(n['source'])}" if n["source"] else ""
+            ds = f" ({when})" if when else ""
+            msgs.append(f"📰 {company}{src}{ds}\n{n['title']}\n{n['url']}")
+
+    # --- Цены по тикерам ---
+    for t in state.tickers:
+        res = quotes_by_ticker.get(t)
+        if res is None or isinstance(res, BaseException):
+            continue
+        sessions, (price, chg, provider) = res
+        if "pre" in sessions:
+            p, c = sessions["pre"]
+            msgs.append(f"🕒 Pre-Market {t}: {p:.2f} USD ({c:+.2f}%) • Yahoo")
+
+        if price is None or chg is None:
+            continue
+        if abs(chg) >= state.price_threshold_pct or state.debug:
+            arrow = "📈" if chg > 0 else "📉" if chg < 0 else "➡️"
+            dbg = " (debug)" if state.debug and abs(chg) < state.price_threshold_pct else ""
+            msgs.append(
+                f"{arrow} {t}: {price:.2f} USD ({chg:+.2f}%) • {provider}{dbg}\n"
+                f"https://finance.yahoo.com/quote/{t}"
+            )
+    return msgs
+
+
+async def send_messages(bot: Bot, chat_id: int, msgs: List[str]):
+    # пакуем сообщения в куски < 4000 символов, без промежуточной склейки всего текста
+    for chunk in split_message(msgs):
+        await send_text(bot, chat_id, chunk)
+
+
+async def run_cycle(bot: Bot, session: aiohttp.ClientSession, due: List[tuple[int, ChatState]]):
+    """Один цикл для всех чатов, которым пора: общий план запросов, затем рассылка."""
+    start_cycle = now_tz()
+    # порядок запросов не важен: результаты раскладываются по словарям
+    companies = list(set().union(*(state.companies for _, state in due)))
+    tickers = list(set().union(*(state.tickers for _, state in due)))
+    news_by_company, quotes_by_ticker = await fetch_plan(session, companies, tickers, PLAN_CACHE_TTL)
+    for key, res in [*news_by_company.items(), *quotes_by_ticker.items()]:
+        if isinstance(res, Exception):
+            log.warning("fetch failed for %s: %r", key, res)
+
+    sends = {}
+    seen_rows: List[tuple[int, int]] = []
+    for chat_id, state in due:
+        if not state.running:  # /stop_feed, пока шли запросы
+            continue
+        msgs = build_messages(chat_id, state, start_cycle, news_by_company, quotes_by_ticker, seen_rows)
+        if msgs:
+            sends[chat_id] = send_messages(bot, chat_id, msgs)
+    await save_seen(seen_rows)  # одна транзакция на цикл, а не commit на каждый чат
+    # чаты не ждут друг друга; темп держит send_text
+    results = await asyncio.gather(*sends.values(), return_exceptions=True)
+    for chat_id, res in zip(sends, results):
+        if isinstance(res, Exception):
+            log.warning("send to chat %s failed: %r", chat_id, res)
+
+
+async def scheduler_loop(bot: Bot):
+    session = await get_session()
+    while True:
+        now = time.monotonic()
+        due = [(chat_id, state) for chat_id, state in STATES.items()
+               if state.running and now - state.last_run >= state.interval_min * 60]
+        if due:
+            for _, state in due:
+                state.last_run = now
+            try:
+                await run_cycle(bot, session, due)
+            except Exception:
+                # не роняем планировщик из-за одного цикла (CancelledError сюда не попадает)
+                log.exception("monitoring cycle failed")
+
+        # спим до ближайшего чата, которому пора (или пока /start_feed не разбудит)
+        now = time.monotonic()
+        waits = [state.last_run + state.interval_min * 60 - now for state in STATES.values() if state.running]
+        SCHEDULER_WAKEUP.clear()
+        try:
+            await asyncio.wait_for(SCHEDULER_WAKEUP.wait(), timeout=max(0.0, min(waits + [SCHEDULER_MAX_SLEEP])))
+        except asyncio.TimeoutError:
+            pass
+
+
+def split_message(blocks: List[str], limit: int = 4000):
+    """Упаковать блоки в сообщения <= limit символов (блоки внутри — через "\n\n").
+    Каждая часть собирается одним join; блок длиннее limit режется жёстко."""
+    parts: List[str] = []
+    buf: List[str] = []
+    size = -2  # длина "\n\n".join(buf): у пустого буфера нет разделителя
+    for block in blocks:
+        pieces = [block[i:i + limit] for i in range(0, len(block), limit)] if len(block) > limit else [block]
+        for piece in pieces:
+            if buf and size + 2 + len(piece) > limit:
+                parts.append("\n\n".join(buf))
+                buf, size = [], -2
+            buf.append(piece)
+            size += 2 + len(piece)
     if buf:
         parts.append("\n\n".join(buf))
     return parts
 
 
 # ====== Команды ======
-@dp.message(CommandStart())
 async def cmd_start(m: Message):
     state = STATES.setdefault(m.chat.id, ChatState())
     await m.answer(
@@ -403,7 +901,6 @@ async def cmd_start(m: Message):
     )
 
 
-@dp.message(Command("watch_company"))
 async def watch_company(m: Message):
     q = (m.text or "").split(maxsplit=1)
     if len(q) < 2:
@@ -412,10 +909,10 @@ async def watch_company(m: Message):
     name = q[1].strip()
     state = STATES.setdefault(m.chat.id, ChatState())
     state.companies.add(name)
+    await save_state(m.chat.id, state)
     await m.answer(f"Добавил компанию: «{name}». Использую Google News (SerpAPI).")
 
 
-@dp.message(Command("unwatch_company"))
 async def unwatch_company(m: Message):
     q = (m.text or "").split(maxsplit=1)
     if len(q) < 2:
@@ -425,12 +922,12 @@ async def unwatch_company(m: Message):
     state = STATES.setdefault(m.chat.id, ChatState())
     if name in state.companies:
         state.companies.remove(name)
+        await save_state(m.chat.id, state)
         await m.answer(f"Убрал компанию: «{name}».")
     else:
         await m.answer("Такой компании нет в списке.")
 
 
-@dp.message(Command("watch_ticker"))
 async def watch_ticker(m: Message):
     q = (m.text or "").split(maxsplit=1)
     if len(q) < 2:
@@ -439,10 +936,10 @@ async def watch_ticker(m: Message):
     t = q[1].strip().upper()
     state = STATES.setdefault(m.chat.id, ChatState())
     state.tickers.add(t)
+    await save_state(m.chat.id, state)
     await m.answer(f"Добавил тикер: {t}. Источник цен — Alpha Vantage.")
 
 
-@dp.message(Command("unwatch_ticker"))
 async def unwatch_ticker(m: Message):
     q = (m.text or "").split(maxsplit=1)
     if len(q) < 2:
@@ -452,16 +949,16 @@ async def unwatch_ticker(m: Message):
     state = STATES.setdefault(m.chat.id, ChatState())
     if t in state.tickers:
         state.tickers.remove(t)
+        await save_state(m.chat.id, state)
         await m.answer(f"Убрал тикер: {t}.")
     else:
         await m.answer("Этого тикера нет в списке.")
 
 
-@dp.message(Command("list"))
 async def cmd_list(m: Message):
     state = STATES.setdefault(m.chat.id, ChatState())
-    companies = ", ".join(sorted(state.companies)) or "—"
-    tickers = ", ".join(sorted(state.tickers)) or "—"
+    companies = ", ".join(state.companies) or "—"
+    tickers = ", ".join(state.tickers) or "—"
     await m.answer(
         f"Компании: {companies}\n"
         f"Тикеры: {tickers}\n"
@@ -471,7 +968,6 @@ async def cmd_list(m: Message):
     )
 
 
-@dp.message(Command("interval"))
 async def cmd_interval(m: Message):
     q = (m.text or "").split(maxsplit=1)
     if len(q) < 2 or not q[1].isdigit():
@@ -479,10 +975,10 @@ async def cmd_interval(m: Message):
         return
     state = STATES.setdefault(m.chat.id, ChatState())
     state.interval_min = max(2, int(q[1]))  # не меньше 2 минут
+    await save_state(m.chat.id, state)
     await m.answer(f"Интервал проверок: {state.interval_min} минут.")
 
 
-@dp.message(Command("threshold"))
 async def cmd_threshold(m: Message):
     q = (m.text or "").split(maxsplit=1)
     if len(q) < 2:
@@ -495,41 +991,38 @@ async def cmd_threshold(m: Message):
         return
     state = STATES.setdefault(m.chat.id, ChatState())
     state.price_threshold_pct = max(0.00001, val)
+    await save_state(m.chat.id, state)
     await m.answer(f"Порог уведомления по цене: {state.price_threshold_pct}%.")
 
 
-@dp.message(Command("start_feed"))
 async def start_feed(m: Message):
     state = STATES.setdefault(m.chat.id, ChatState())
     if state.running:
         await m.answer("Мониторинг уже запущен.")
         return
     state.running = True
-    bot = Bot(TELEGRAM_BOT_TOKEN)
-    state.task = asyncio.create_task(monitor_chat(bot, m.chat.id))
+    state.last_run = float("-inf")  # первый цикл — сразу
+    await save_state(m.chat.id, state)
+    SCHEDULER_WAKEUP.set()
     await m.answer("Мониторинг запущен ✅")
 
 
-@dp.message(Command("stop_feed"))
 async def stop_feed(m: Message):
     state = STATES.setdefault(m.chat.id, ChatState())
     state.running = False
-    if state.task and not state.task.done():
-        state.task.cancel()
+    await save_state(m.chat.id, state)
     await m.answer("Мониторинг остановлен ⏸️")
 
 
-@dp.message(F.text & ~F.via_bot & ~F.text.regexp(r'^/'))
+@dp.message(F.text & ~F.via_bot & ~F.text.regexp(_CMD_RE))
 async def fallback(m: Message):
     await m.answer("Неизвестная команда. Используй /help или /start.")
 
 
-@dp.message(Command("help"))
 async def help_cmd(m: Message):
     await cmd_start(m)
 
-@dp.message(Command("price"))
-async def cmd_price(m: Message, command: Command = None):
+async def cmd_price(m: Message):
     text = (m.text or "").strip()
     arg = text.split(maxsplit=1)
     symbol = ""
@@ -540,8 +1033,8 @@ async def cmd_price(m: Message, command: Command = None):
         return
 
     symbol = symbol.upper()
-    async with aiohttp.ClientSession() as session:
-        price, chg, provider = await get_stock_price(session, symbol)
+    # одновременные /price по одному тикеру ждут один общий запрос (см. _cached)
+    price, chg, provider = await cached_get_stock_price(await get_session(), symbol, COMMAND_CACHE_TTL)
 
     if price is None or chg is None:
         await m.answer(f"Не удалось получить котировку для {symbol}. Возможны лимиты или нерабочие часы.")
@@ -553,15 +1046,13 @@ async def cmd_price(m: Message, command: Command = None):
         f"https://finance.yahoo.com/quote/{symbol}"
     )
 
-@dp.message(Command("premarket"))
 async def cmd_premarket(m: Message):
     parts = (m.text or "").strip().split(maxsplit=1)
     if len(parts) < 2:
         await m.answer("Использование: /premarket <тикер>, напр. /premarket NVDA")
         return
     symbol = parts[1].strip().upper()
-    async with aiohttp.ClientSession() as session:
-        sessions = await fetch_yahoo_sessions(session, symbol)
+    sessions = await cached_fetch_yahoo_sessions(await get_session(), symbol, COMMAND_CACHE_TTL)
 
     if not RAPIDAPI_KEY:
         await m.answer("RAPIDAPI_KEY не задан — не могу получить Pre-Market с Yahoo.")
@@ -579,11 +1070,62 @@ async def cmd_premarket(m: Message):
         p, c = sessions["regular"]; lines.append(f"🏛 Regular: {p:.2f} USD ({c:+.2f}%)")
     await m.answer("\n".join(lines))
 
+# одна таблица вместо отдельного фильтра Command(...) на каждую команду
+COMMANDS: Dict[str, Callable[[Message], Awaitable]] = {
+    "/start": cmd_start,
+    "/help": help_cmd,
+    "/watch_company": watch_company,
+    "/unwatch_company": unwatch_company,
+    "/watch_ticker": watch_ticker,
+    "/unwatch_ticker": unwatch_ticker,
+    "/list": cmd_list,
+    "/interval": cmd_interval,
+    "/threshold": cmd_threshold,
+    "/start_feed": start_feed,
+    "/stop_feed": stop_feed,
+    "/price": cmd_price,
+    "/premarket": cmd_premarket,
+}
+
+
+@dp.message(F.text.startswith("/"))
+async def dispatch_command(m: Message, bot: Bot):
+    """Разбор команды одним словарным поиском; /cmd@botname — только если botname это мы."""
+    cmd, _, mention = m.text.split(maxsplit=1)[0].partition("@")
+    # в группе с несколькими ботами чужие команды не трогаем (как validate_mention в Command)
+    if mention and mention.lower() != ((await bot.me()).username or "").lower():
+        return
+    handler = COMMANDS.get(cmd.lower())
+    if handler is None:
+        # без упоминания команда могла быть адресована другому боту группы
+        if mention or m.chat.type == "private":
+            await fallback(m)
+        return
+    await handler(m)
+
+
 # ====== Запуск ======
 async def main():
-    bot = Bot(TELEGRAM_BOT_TOKEN)
-    await dp.start_polling(bot)
+    global BOT
+    BOT = Bot(TELEGRAM_BOT_TOKEN)
+    session = await get_session()
+    init_db()
+    # чаты, у которых мониторинг был включён до перезапуска, подхватит планировщик
+    load_states()
+    scheduler = asyncio.create_task(scheduler_loop(BOT))
+    try:
+        await dp.start_polling(BOT)
+    finally:
+        # дожидаемся отмены, чтобы цикл не писал в уже закрытые сессию и базу
+        scheduler.cancel()
+        with suppress(asyncio.CancelledError):
+            await scheduler
+        await session.close()
+        await BOT.session.close()
+        DB_EXECUTOR.shutdown(wait=True)  # дописать то, что ещё в очереди
+        DB.close()
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
     asyncio.run(main())